@@ -1 +1,7 @@
+import os
+
+# Select the native (upb) protobuf backend before any generated proto module is imported.
+# An explicit setting from the environment takes precedence.
+os.environ.setdefault('PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION', 'upb')
+
 from .stage import run_stage
\ No newline at end of file
@@ -2,7 +2,7 @@ import os
 from enum import Enum
 from typing import List, Literal, Optional
 
-from geojson_pydantic import Polygon
+from geojson_pydantic import MultiPolygon, Polygon
 from pydantic import BaseModel, Field
 from pydantic_settings import (BaseSettings, SettingsConfigDict,
                                YamlConfigSettingsSource)
@@ -15,6 +15,8 @@ class RedisConfig(BaseModel):
     port: Annotated[int, Field(ge=1, le=65536)] = 6379
     input_stream_prefix: str = 'objecttracker'
     output_stream_prefix: str = 'geomapper'
+    output_batch_size: Annotated[int, Field(ge=1)] = 1
+    output_batch_max_latency_ms: Annotated[float, Field(ge=0)] = 2
 
 class CameraMode(str, Enum):
     COPY = 'copy'
@@ -44,7 +46,7 @@ class CameraGeomappingConfig(BaseModel):
     brown_distortion_k1: Optional[float] = None
     brown_distortion_k2: Optional[float] = None
     brown_distortion_k3: Optional[float] = None
-    mapping_area: Optional[Polygon] = None
+    mapping_area: Optional[Polygon | MultiPolygon] = None
     remove_unmapped_detections: bool = False
 
 CameraConfig = Annotated[CameraGeomappingConfig | CameraCopyConfig, Field(discriminator='mode')]
@@ -54,6 +56,7 @@ class GeoMapperConfig(BaseSettings):
     redis: RedisConfig = RedisConfig()
     cameras: List[CameraConfig] = Field(min_length=1)
     object_center_elevation_m: float = 0
+    use_enu_approx: bool = False
     prometheus_port: Annotated[int, Field(gt=1024, le=65536)] = 8000
 
     model_config = SettingsConfigDict(env_nested_delimiter='__')
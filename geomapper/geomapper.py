@@ -1,30 +1,46 @@
+import functools
 import logging
-from typing import Any, Dict, List, NamedTuple
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import cameratransform as ct
+import numpy as np
+import shapely
 from cameratransform.camera import Camera
+from google.protobuf.internal import api_implementation
 from prometheus_client import Counter, Histogram, Summary
-from shapely import Point as ShapelyPoint
-from shapely import Polygon
-from shapely.geometry import shape
-from visionapi.sae_pb2 import BoundingBox, Detection, SaeMessage
+from shapely import MultiPolygon, Polygon, STRtree
+from visionapi.sae_pb2 import SaeMessage
 from visionapi.common_pb2 import MessageType
 
-from .config import GeoMapperConfig, CameraConfig, CameraMode
+from .config import GeoMapperConfig, CameraMode
 
 logging.basicConfig(format='%(asctime)s %(name)-15s %(levelname)-8s %(processName)-10s %(message)s')
 logger = logging.getLogger(__name__)
 
+if api_implementation.Type() == 'python':
+    logger.warning('Protobuf is using the pure Python implementation, (de)serialization will be slow. Make sure protobuf>=4.21 is installed.')
+
 GET_DURATION = Histogram('geo_mapper_get_duration', 'The time it takes to deserialize the proto until returning the tranformed result as a serialized proto',
                          buckets=(0.0025, 0.005, 0.0075, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.25))
 TRANSFORM_DURATION = Summary('geo_mapper_transform_duration', 'How long the coordinate transformation takes')
 OBJECT_COUNTER = Counter('geo_mapper_object_counter', 'How many detections have been transformed')
-PROTO_SERIALIZATION_DURATION = Summary('geo_mapper_proto_serialization_duration', 'The time it takes to create a serialized output proto')
-PROTO_DESERIALIZATION_DURATION = Summary('geo_mapper_proto_deserialization_duration', 'The time it takes to deserialize an input proto')
+UNEXPECTED_MESSAGE_COUNTER = Counter('geo_mapper_unexpected_message_counter', 'How many messages have been discarded because they are not of type SAE')
+
+# Mean earth radius, as used by cameratransform for its gps conversion
+EARTH_RADIUS_M = 6371e3
 
-class Point(NamedTuple):
-    x: float
-    y: float
+class _StreamContext(NamedTuple):
+    '''Everything needed to map the detections of one stream, resolved once at setup'''
+    camera: Camera
+    half_image_size_px: np.ndarray
+    camera_to_space: np.ndarray
+    image_to_space: Optional[np.ndarray]
+    camera_position_m: np.ndarray
+    project: Callable[..., Tuple[np.ndarray, np.ndarray]]
+    mapping_area: Optional[Union[Polygon, STRtree]]
+    remove_unmapped_detections: bool
+    object_center_elevation_m: float
 
 
 class GeoMapper:
@@ -32,16 +48,17 @@ class GeoMapper:
         self._config = config
         logger.setLevel(self._config.log_level.value)
 
-        self._cameras: Dict[str, ct.Camera] = dict()
-        self._cam_configs: Dict[str, CameraConfig] = dict()
-        self._mapping_areas: Dict[str, Polygon] = dict()
+        # The transformation for each stream is fixed, so it is resolved once (incl. all arguments) at setup
+        self._handlers: Dict[str, Callable[[SaeMessage], None]] = dict()
+        # Reused for every incoming message (GeoMapper is only ever called from a single thread)
+        self._sae_msg = SaeMessage()
         self._setup()
 
     def _setup(self):
         for cam_conf in self._config.cameras:
-            self._cam_configs[cam_conf.stream_id] = cam_conf
-
-            if cam_conf.mode == CameraMode.MAP:
+            if cam_conf.mode == CameraMode.COPY:
+                self._handlers[cam_conf.stream_id] = self._transform_detections_copy
+            elif cam_conf.mode == CameraMode.MAP:
                 lens_correction = ct.NoDistortion()
                 if cam_conf.abc_distortion_a is not None:
                     lens_correction = ct.ABCDistortion(
@@ -74,97 +91,222 @@ class GeoMapper:
                     ),
                     lens=lens_correction,
                 )
-            
-                self._cameras[cam_conf.stream_id] = camera
 
+                # Without lens distortion, image -> space is linear and can be folded into a single matrix
+                image_to_space = None
+                if isinstance(lens_correction, ct.NoDistortion):
+                    image_to_space = _image_to_camera_matrix(camera.projection) @ camera.orientation.R_inv.T
+
+                mapping_area = None
                 if cam_conf.mapping_area is not None:
-                    self._mapping_areas[cam_conf.stream_id] = shape(cam_conf.mapping_area)
+                    # Let GEOS parse the GeoJSON natively instead of going through the Python `__geo_interface__` adapter
+                    mapping_area = shapely.from_geojson(cam_conf.mapping_area.model_dump_json(exclude_none=True))
+                    if isinstance(mapping_area, MultiPolygon):
+                        # Index the parts, so that each point is only tested against polygons whose bounds contain it
+                        mapping_area = STRtree(list(mapping_area.geoms))
+                    else:
+                        # Build the GEOS spatial index once, instead of implicitly on every containment check
+                        shapely.prepare(mapping_area)
+
+                ctx = _StreamContext(
+                    camera=camera,
+                    half_image_size_px=0.5 * np.array([
+                        camera.parameters.parameters['image_width_px'].value,
+                        camera.parameters.parameters['image_height_px'].value,
+                    ], dtype=np.float64),
+                    # The orientation of a camera is static, only its gps position changes per message
+                    camera_to_space=camera.orientation.R_inv.T.copy(),
+                    image_to_space=image_to_space,
+                    camera_position_m=np.array(camera.orientation.t, dtype=np.float64),
+                    project=_project_enu if self._config.use_enu_approx else _project_batch,
+                    mapping_area=mapping_area,
+                    remove_unmapped_detections=cam_conf.remove_unmapped_detections,
+                    object_center_elevation_m=self._config.object_center_elevation_m,
+                )
+                self._handlers[cam_conf.stream_id] = functools.partial(self._transform_detections_map, ctx=ctx)
 
     def __call__(self, input_proto) -> Any:
         return self.get(input_proto)
     
-    @GET_DURATION.time()
     def get(self, input_proto):
+        start = time.perf_counter()
+        try:
+            return self._get(input_proto)
+        finally:
+            GET_DURATION.observe(time.perf_counter() - start)
+
+    def _get(self, input_proto):
         sae_msg = self._unpack_proto(input_proto)
-        if not sae_msg.type == MessageType.SAE:
-            logger.warning(f'Unexpected message type {sae_msg.type}, discarding message')
+        if sae_msg.type != MessageType.SAE:
+            UNEXPECTED_MESSAGE_COUNTER.inc()
+            logger.warning('Unexpected message type %s, discarding message', sae_msg.type)
             return None
 
-        source_id = sae_msg.frame.source_id
+        frame = sae_msg.frame
+        source_id = frame.source_id
 
-        if not sae_msg.frame.HasField('camera_location'):
-            logger.warning(f'Camera location is not set, discarding message (source_id={source_id})')
-            return None
+        handler = self._handlers.get(source_id, None)
 
-        cam_config = self._cam_configs.get(source_id, None)
+        if handler is None:
+            logger.warning('No config for message source_id=%s found, possible stream_id/source_id mismatch, discarding message', source_id)
+            return None
 
-        if cam_config is None:
-            logger.warning(f'No config for message source_id={source_id} found, possible stream_id/source_id mismatch, discarding message')
+        if not frame.HasField('camera_location'):
+            logger.warning('Camera location is not set, discarding message (source_id=%s)', source_id)
             return None
         
-        if cam_config.mode == CameraMode.COPY:
-            self._transform_detections_copy(sae_msg)
-        elif cam_config.mode == CameraMode.MAP:
-            camera = self._cameras.get(source_id, None)
-            self._transform_detections_map(sae_msg, camera)
+        handler(sae_msg)
 
         return self._pack_proto(sae_msg)
     
     def _transform_detections_copy(self, sae_msg: SaeMessage) -> None:
         '''Copy camera location to all detections in the message'''
-        lat = sae_msg.frame.camera_location.latitude
-        lon = sae_msg.frame.camera_location.longitude
+        camera_location = sae_msg.frame.camera_location
+        lat = camera_location.latitude
+        lon = camera_location.longitude
 
         for detection in sae_msg.detections:
             detection.geo_coordinate.latitude = lat
             detection.geo_coordinate.longitude = lon
       
-    def _transform_detections_map(self, sae_msg: SaeMessage, camera: Camera) -> None:
+    def _transform_detections_map(self, sae_msg: SaeMessage, ctx: _StreamContext) -> None:
         '''Map detections into coordinate space, add coordinate to message and optionally filter detections that were not mapped'''
-        # Cameras can move, so we read the location from current message
-        camera.setGPSpos(sae_msg.frame.camera_location.latitude, sae_msg.frame.camera_location.longitude)
-        
-        stream_id = sae_msg.frame.source_id
-        image_height_px = camera.parameters.parameters['image_height_px'].value
-        image_width_px = camera.parameters.parameters['image_width_px'].value
-
-        retained_detections: List[Detection] = []
+        unmapped_indices: List[int] = []
 
         with TRANSFORM_DURATION.time():
-            for detection in sae_msg.detections:
-                center = self._get_center(detection.bounding_box)
-                gps = camera.gpsFromImage([center.x * image_width_px, center.y * image_height_px], Z=self._config.object_center_elevation_m)
-                lat, lon = gps[0], gps[1]
-                if self._is_filtered(stream_id, lat, lon):
-                    logger.debug(f'SKIPPED: cls {detection.class_id}, oid {detection.object_id.hex()}, lat {lat}, lon {lon}')
-                    continue
-                detection.geo_coordinate.latitude = lat
-                detection.geo_coordinate.longitude = lon
-                retained_detections.append(detection)
-                logger.debug(f'cls {detection.class_id}, oid {detection.object_id.hex()}, lat {lat}, lon {lon}')
+            detections = sae_msg.detections
+            detection_count = len(detections)
+            if detection_count > 0:
+                # Read all bounding boxes into one (N, 4) array of min_x, min_y, max_x, max_y
+                bboxes = [detection.bounding_box for detection in detections]
+                corners = np.fromiter(
+                    (coord for bbox in bboxes for coord in (bbox.min_x, bbox.min_y, bbox.max_x, bbox.max_y)),
+                    dtype=np.float64,
+                    count=4 * detection_count,
+                ).reshape(detection_count, 4)
+                centers = (corners[:, :2] + corners[:, 2:]) * ctx.half_image_size_px
+
+                if ctx.image_to_space is not None:
+                    rays = np.ones((detection_count, 3), dtype=np.float64)
+                    rays[:, :2] = centers
+                    to_space = ctx.image_to_space
+                else:
+                    rays = ctx.camera.projection.getRay(ctx.camera.lens.imageFromDistorted(centers))
+                    to_space = ctx.camera_to_space
+
+                # Cameras can move, so we read the location from current message
+                camera_location = sae_msg.frame.camera_location
+                lats, lons = ctx.project(
+                    rays,
+                    to_space,
+                    ctx.camera_position_m,
+                    camera_location.latitude,
+                    camera_location.longitude,
+                    ctx.object_center_elevation_m,
+                )
+
+                if ctx.mapping_area is not None:
+                    is_mapped = _contains_xy(ctx.mapping_area, lons, lats)
+                else:
+                    is_mapped = np.ones(detection_count, dtype=bool)
+
+                # f-strings are evaluated eagerly, so only build the per-detection log messages if they are going to be emitted
+                log_debug = logger.isEnabledFor(logging.DEBUG)
+
+                # Convert to native Python floats / bools in one go, instead of boxing a NumPy scalar per element and field assignment
+                for idx, (detection, lat, lon, mapped) in enumerate(zip(detections, lats.tolist(), lons.tolist(), is_mapped.tolist())):
+                    if not mapped:
+                        if log_debug:
+                            logger.debug(f'SKIPPED: cls {detection.class_id}, oid {detection.object_id.hex()}, lat {lat}, lon {lon}')
+                        unmapped_indices.append(idx)
+                        continue
+                    detection.geo_coordinate.latitude = lat
+                    detection.geo_coordinate.longitude = lon
+                    if log_debug:
+                        logger.debug(f'cls {detection.class_id}, oid {detection.object_id.hex()}, lat {lat}, lon {lon}')
         
-        if self._cam_configs[stream_id].remove_unmapped_detections:
-            sae_msg.ClearField('detections')
-            sae_msg.detections.extend(retained_detections)
-
-    def _get_center(self, bbox: BoundingBox) -> Point:
-        return Point(
-            x=(bbox.min_x + bbox.max_x) / 2,
-            y=(bbox.min_y + bbox.max_y) / 2
-        )
-    
-    def _is_filtered(self, cam_id: str, lat: float, lon: float):
-        if cam_id in self._mapping_areas:
-            point = ShapelyPoint(lon, lat)
-            return not self._mapping_areas[cam_id].contains(point)
+        if ctx.remove_unmapped_detections:
+            # Delete back to front, so that the remaining indices stay valid
+            for idx in reversed(unmapped_indices):
+                del sae_msg.detections[idx]
 
-    @PROTO_DESERIALIZATION_DURATION.time()
     def _unpack_proto(self, sae_message_bytes):
-        sae_msg = SaeMessage()
-        sae_msg.ParseFromString(sae_message_bytes)
+        # ParseFromString clears the message before parsing, so nothing from the previous message is carried over
+        self._sae_msg.ParseFromString(sae_message_bytes)
 
-        return sae_msg
+        return self._sae_msg
     
-    @PROTO_SERIALIZATION_DURATION.time()
     def _pack_proto(self, sae_msg: SaeMessage):
-        return sae_msg.SerializeToString()
\ No newline at end of file
+        # SaeMessage is a proto3 message, i.e. it has no required fields that could be missing.
+        # The full serialization would only add a (pointless) initialization check of the whole message tree.
+        return sae_msg.SerializePartialToString()
+
+
+def _image_to_camera_matrix(projection: ct.RectilinearProjection) -> np.ndarray:
+    '''Return the matrix that turns homogeneous (undistorted) image points [x, y, 1] into rays in camera coordinates.
+    This is the linear form of `RectilinearProjection.getRay`.'''
+    fx, fy = projection.focallength_x_px, projection.focallength_y_px
+    cx, cy = projection.center_x_px, projection.center_y_px
+    return np.array([
+        [1 / fx, 0, 0],
+        [0, -1 / fy, 0],
+        [-cx / fx, cy / fy, -1],
+    ], dtype=np.float64)
+
+
+def _intersect_plane(rays: np.ndarray, to_space: np.ndarray, camera_position_m: np.ndarray, z: float) -> Tuple[np.ndarray, np.ndarray]:
+    '''Transform (N, 3) rays into space coordinates with `to_space` and intersect them with the plane at elevation z.
+    Returns the east and north coordinates of the intersections in meters (the local metric space coordinate system of cameratransform).
+    Rays that do not hit the plane in front of the camera result in NaN coordinates.'''
+    direction = rays @ to_space
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = (z - camera_position_m[2]) / direction[:, 2]
+    factor[factor < 0] = np.nan
+    east = direction[:, 0] * factor + camera_position_m[0]
+    north = direction[:, 1] * factor + camera_position_m[1]
+
+    return east, north
+
+
+def _project_batch(rays: np.ndarray, to_space: np.ndarray, camera_position_m: np.ndarray,
+                   camera_lat: float, camera_lon: float, z: float) -> Tuple[np.ndarray, np.ndarray]:
+    '''Project (N, 3) rays onto the plane at elevation z and return the latitudes and longitudes of the intersections.
+    This is equivalent to cameratransform's `Camera.gpsFromImage` (minus the image -> ray step), but without its per-call overhead.'''
+    east, north = _intersect_plane(rays, to_space, camera_position_m, z)
+
+    # Move from the camera position along the great circle towards the intersection (see `cameratransform.gps.moveDistance`)
+    bearing = np.arctan2(east, north)
+    angular_distance = np.hypot(east, north) / (EARTH_RADIUS_M + camera_position_m[2])
+    lat1 = np.deg2rad(camera_lat)
+    sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sin_dist, cos_dist = np.sin(angular_distance), np.cos(angular_distance)
+
+    lat2 = np.arcsin(sin_lat1 * cos_dist + cos_lat1 * sin_dist * np.cos(bearing))
+    lon2 = np.arctan2(np.sin(bearing) * sin_dist * cos_lat1, cos_dist - sin_lat1 * np.sin(lat2))
+
+    return np.rad2deg(lat2), camera_lon + np.rad2deg(lon2)
+
+
+def _project_enu(rays: np.ndarray, to_space: np.ndarray, camera_position_m: np.ndarray,
+                 camera_lat: float, camera_lon: float, z: float) -> Tuple[np.ndarray, np.ndarray]:
+    '''Same as `_project_batch`, but converts to gps coordinates with a local tangent plane (east, north, up) approximation.
+    This needs no per-point trigonometry. The error grows with the square of the distance from the camera,
+    but stays within a few centimeters at 500m (and below a meter at 2km) in mid latitudes.'''
+    east, north = _intersect_plane(rays, to_space, camera_position_m, z)
+
+    radius = EARTH_RADIUS_M + camera_position_m[2]
+    lat_deg_per_m = np.rad2deg(1 / radius)
+    lon_deg_per_m = lat_deg_per_m / np.cos(np.deg2rad(camera_lat))
+
+    return camera_lat + north * lat_deg_per_m, camera_lon + east * lon_deg_per_m
+
+
+def _contains_xy(mapping_area: Union[Polygon, STRtree], x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    '''Return a boolean mask of which points lie within the mapping area (either a single polygon or a tree of polygons)'''
+    if isinstance(mapping_area, STRtree):
+        point_idx, _ = mapping_area.query(shapely.points(x, y), predicate='within')
+        mask = np.zeros(len(x), dtype=bool)
+        mask[point_idx] = True
+        return mask
+    return shapely.contains_xy(mapping_area, x, y)
@@ -1,6 +1,10 @@
 import logging
+import queue
 import signal
+import struct
 import threading
+import time
+from typing import Callable, Dict, List, Optional
 
 from prometheus_client import Counter, Histogram, start_http_server
 from visionlib.pipeline.consumer import RedisConsumer
@@ -15,6 +19,59 @@ REDIS_PUBLISH_DURATION = Histogram('geo_mapper_redis_publish_duration', 'The tim
                                    buckets=(0.0025, 0.005, 0.0075, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.25))
 FRAME_COUNTER = Counter('geo_mapper_frame_counter', 'How many frames have been consumed from the Redis input stream')
 
+# How many consumed messages may be waiting for processing
+INPUT_QUEUE_SIZE = 4
+QUEUE_POLL_INTERVAL_S = 0.1
+
+_END_OF_STREAM = object()
+
+
+class _OutputBatcher:
+    '''Collects output messages per stream and publishes up to `batch_size` of them as one Redis stream entry.
+    If `batch_size` is 1, every message is published as is. Otherwise, the payload of an entry is the concatenation
+    of all messages in the batch, each prefixed with its length as 4 byte big-endian unsigned integer.
+    A batch is published at the latest `max_latency_s` after its first message has been added.'''
+    def __init__(self, publish: Callable[[str, bytes], None], batch_size: int, max_latency_s: float) -> None:
+        self._publish = publish
+        self._batch_size = batch_size
+        self._max_latency_s = max_latency_s
+        self._batches: Dict[str, List[bytes]] = dict()
+        self._deadlines: Dict[str, float] = dict()
+
+    def add(self, stream: str, data: bytes) -> None:
+        batch = self._batches.setdefault(stream, [])
+        if len(batch) == 0:
+            self._deadlines[stream] = time.monotonic() + self._max_latency_s
+        batch.append(data)
+
+        if len(batch) >= self._batch_size:
+            self._flush(stream)
+
+    def next_deadline(self) -> Optional[float]:
+        return min(self._deadlines.values(), default=None)
+
+    def flush_due(self) -> None:
+        now = time.monotonic()
+        for stream in [stream for stream, deadline in self._deadlines.items() if deadline <= now]:
+            self._flush(stream)
+
+    def flush_all(self) -> None:
+        for stream in list(self._batches.keys()):
+            self._flush(stream)
+
+    def _flush(self, stream: str) -> None:
+        batch = self._batches.pop(stream)
+        del self._deadlines[stream]
+
+        if self._batch_size == 1:
+            payload = batch[0]
+        else:
+            payload = b''.join(struct.pack('>I', len(data)) + data for data in batch)
+
+        with REDIS_PUBLISH_DURATION.time():
+            self._publish(stream, payload)
+
+
 def run_stage():
 
     stop_event = threading.Event()
@@ -45,23 +102,72 @@ def run_stage():
                                  stream_keys=[f'{CONFIG.redis.input_stream_prefix}:{cam.stream_id}' for cam in CONFIG.cameras])
     publisher_ctx = RedisPublisher(CONFIG.redis.host, CONFIG.redis.port)
 
+    input_queue = queue.Queue(maxsize=INPUT_QUEUE_SIZE)
+
+    def put_input(item):
+        while not stop_event.is_set():
+            try:
+                input_queue.put(item, timeout=QUEUE_POLL_INTERVAL_S)
+                return
+            except queue.Full:
+                pass
+
+    # Reading from Redis happens in a separate thread, so that waiting for the next message overlaps with processing the current one.
+    # All GeoMapper calls stay on the main thread.
+    def read_messages(iter_messages):
+        try:
+            for stream_key, proto_data in iter_messages():
+                if stop_event.is_set():
+                    return
+
+                if stream_key is None:
+                    continue
+
+                put_input((stream_key, proto_data))
+        except Exception as e:
+            put_input(e)
+        else:
+            put_input(_END_OF_STREAM)
+
     with consumer_ctx as iter_messages, publisher_ctx as publish:
-        for stream_key, proto_data in iter_messages():
-            if stop_event.is_set():
-                break
+        batcher = _OutputBatcher(publish, CONFIG.redis.output_batch_size, CONFIG.redis.output_batch_max_latency_ms / 1000)
+
+        reader_thread = threading.Thread(target=read_messages, args=(iter_messages,), name='redis-reader', daemon=True)
+        reader_thread.start()
+
+        try:
+            while not stop_event.is_set():
+                # Do not wait for input longer than until the next pending output batch is due
+                timeout = QUEUE_POLL_INTERVAL_S
+                next_deadline = batcher.next_deadline()
+                if next_deadline is not None:
+                    timeout = min(timeout, max(next_deadline - time.monotonic(), 0))
+
+                try:
+                    item = input_queue.get(timeout=timeout)
+                except queue.Empty:
+                    batcher.flush_due()
+                    continue
+
+                if item is _END_OF_STREAM:
+                    break
+
+                if isinstance(item, Exception):
+                    raise item
+
+                stream_key, proto_data = item
+                stream_id = stream_key.split(':')[1]
 
-            if stream_key is None:
-                continue
+                FRAME_COUNTER.inc()
 
-            stream_id = stream_key.split(':')[1]
+                output_proto_data = geo_mapper.get(proto_data)
 
-            FRAME_COUNTER.inc()
+                if output_proto_data is not None:
+                    batcher.add(f'{CONFIG.redis.output_stream_prefix}:{stream_id}', output_proto_data)
 
-            output_proto_data = geo_mapper.get(proto_data)
+                batcher.flush_due()
 
-            if output_proto_data is None:
-                continue
-            
-            with REDIS_PUBLISH_DURATION.time():
-                publish(f'{CONFIG.redis.output_stream_prefix}:{stream_id}', output_proto_data)
-            
\ No newline at end of file
+            batcher.flush_all()
+        finally:
+            stop_event.set()
+            reader_thread.join()
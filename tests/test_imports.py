@@ -2,11 +2,10 @@ import pytest
 
 def test_geommapper_import():
     try:
-        from geomapper.geomapper import GeoMapper, Point
+        from geomapper.geomapper import GeoMapper
     except ImportError as e:
         pytest.fail(f"Failed to import GeoMapper: {e}")
 
     assert GeoMapper is not None, "GeoMapper should be imported successfully"
-    assert Point is not None, "Point should be imported successfully"
         
         
\ No newline at end of file
@@ -1,3 +1,4 @@
+import struct
 from typing import List, Tuple
 from unittest.mock import patch
 
@@ -17,13 +18,14 @@ def disable_prometheus():
 @pytest.fixture
 def set_cameras_config():
     with patch('geomapper.stage.GeoMapperConfig') as mock_config:
-        def _make_mock_config(cameras):
+        def _make_mock_config(cameras, **kwargs):
+            kwargs.setdefault('redis', RedisConfig(
+                output_stream_prefix='output_prefix',
+            ))
             mock_config.return_value = GeoMapperConfig(
                 log_level='WARNING',
                 cameras=cameras,
-                redis=RedisConfig(
-                    output_stream_prefix='output_prefix',
-                )
+                **kwargs,
             )
         yield _make_mock_config
 
@@ -96,6 +98,81 @@ def test_copy_mode(redis_publisher_mock, inject_consumer_messages, set_cameras_c
         assert detection.geo_coordinate.latitude == 10.0
         assert detection.geo_coordinate.longitude == 20.0
 
+def test_consecutive_messages(redis_publisher_mock, inject_consumer_messages, set_cameras_config):
+    set_cameras_config([CameraCopyConfig(stream_id='stream1')])
+
+    inject_consumer_messages([
+        ('objecttracker:stream1', _make_sae_msg_bytes(timestamp=1, 
+                                                      source_id='stream1',
+                                                      location=(10.0, 20.0), 
+                                                      detections=[
+                                                          _make_detection((0.5, 0.5), 1),
+                                                          _make_detection((0.6, 0.6), 2),
+                                                      ])),
+        ('objecttracker:stream1', _make_sae_msg_bytes(timestamp=2, 
+                                                      source_id='stream1',
+                                                      location=(11.0, 21.0), 
+                                                      detections=[
+                                                          _make_detection((0.5, 0.5), 3),
+                                                      ])),
+    ])
+
+    run_stage()
+
+    assert redis_publisher_mock.call_count == 2
+
+    # Assert that nothing from the first message leaks into the second one
+    msg = SaeMessage()
+    msg.ParseFromString(redis_publisher_mock.call_args_list[1].args[1])
+    assert msg.frame.timestamp_utc_ms == 2
+    assert len(msg.detections) == 1
+    assert msg.detections[0].class_id == 3
+    assert msg.detections[0].geo_coordinate.latitude == 11.0
+    assert msg.detections[0].geo_coordinate.longitude == 21.0
+
+def test_consumer_error(redis_publisher_mock, inject_consumer_messages, set_cameras_config):
+    set_cameras_config([CameraCopyConfig(stream_id='stream1')])
+
+    def _failing_messages():
+        yield ('objecttracker:stream1', _make_sae_msg_bytes(timestamp=1, 
+                                                            source_id='stream1',
+                                                            location=(10.0, 20.0)))
+        raise ConnectionError('Connection to Redis lost')
+
+    inject_consumer_messages(_failing_messages())
+
+    # Assert that errors while reading messages are not swallowed by the reader thread
+    with pytest.raises(ConnectionError):
+        run_stage()
+
+    assert redis_publisher_mock.call_count == 1
+
+def test_output_batching(redis_publisher_mock, inject_consumer_messages, set_cameras_config):
+    set_cameras_config([CameraCopyConfig(stream_id='stream1')], redis=RedisConfig(
+        output_stream_prefix='output_prefix',
+        output_batch_size=2,
+        output_batch_max_latency_ms=60000,
+    ))
+
+    inject_consumer_messages([
+        ('objecttracker:stream1', _make_sae_msg_bytes(timestamp=ts, 
+                                                      source_id='stream1',
+                                                      location=(10.0, 20.0))) for ts in (1, 2, 3)
+    ])
+
+    run_stage()
+
+    # Assert that the first two messages are published as one batch and the remaining one is flushed on exit
+    assert redis_publisher_mock.call_count == 2
+    assert [call.args[0] for call in redis_publisher_mock.call_args_list] == ['output_prefix:stream1'] * 2
+
+    batches = [_unpack_batch(call.args[1]) for call in redis_publisher_mock.call_args_list]
+    assert [len(batch) for batch in batches] == [2, 1]
+
+    msg = SaeMessage()
+    msg.ParseFromString(batches[1][0])
+    assert msg.frame.timestamp_utc_ms == 3
+
 def test_map_mode_no_location(redis_publisher_mock, inject_consumer_messages, set_cameras_config):
     set_cameras_config([CameraGeomappingConfig(
         stream_id='stream1',
@@ -156,6 +233,256 @@ def test_map_mode_with_location(redis_publisher_mock, inject_consumer_messages,
         assert 0.00001 < (10.0 - detection.geo_coordinate.latitude) < 0.01
         assert 0.00001 < (detection.geo_coordinate.longitude - 20.0) < 0.01
 
+def test_map_mode_enu_approximation(redis_publisher_mock, inject_consumer_messages, set_cameras_config):
+    set_cameras_config([CameraGeomappingConfig(
+        stream_id='stream1',
+        heading_deg=135.0,
+        image_width_px=1920,
+        image_height_px=1080,
+        view_x_deg=60.0,
+        tilt_deg=45.0,
+        elevation_m=10.0,
+    )], use_enu_approx=True)
+
+    inject_consumer_messages([
+        ('objecttracker:stream1', _make_sae_msg_bytes(timestamp=1, 
+                                                      source_id='stream1',
+                                                      location=(10.0, 20.0),
+                                                      detections=[
+                                                          _make_detection((0.5, 0.9), 1),  # bottom of image
+                                                      ])),
+    ])
+
+    run_stage()
+
+    assert redis_publisher_mock.call_count == 1
+
+    # At this distance the approximation must be practically identical to the exact mapping (1e-7 deg ~ 1cm)
+    msg = SaeMessage()
+    msg.ParseFromString(redis_publisher_mock.call_args_list[0].args[1])
+    assert len(msg.detections) == 1
+    assert msg.detections[0].geo_coordinate.latitude == pytest.approx(9.99996264, abs=1e-7)
+    assert msg.detections[0].geo_coordinate.longitude == pytest.approx(20.00003794, abs=1e-7)
+
+def test_map_mode_with_lens_distortion(redis_publisher_mock, inject_consumer_messages, set_cameras_config):
+    set_cameras_config([CameraGeomappingConfig(
+        stream_id='stream1',
+        heading_deg=135.0,
+        image_width_px=1920,
+        image_height_px=1080,
+        view_x_deg=60.0,
+        tilt_deg=45.0,
+        elevation_m=10.0,
+        brown_distortion_k1=0.0,
+        brown_distortion_k2=0.0,
+        brown_distortion_k3=0.0,
+    )])
+
+    inject_consumer_messages([
+        ('objecttracker:stream1', _make_sae_msg_bytes(timestamp=1, 
+                                                      source_id='stream1',
+                                                      location=(10.0, 20.0),
+                                                      detections=[
+                                                          _make_detection((0.5, 0.9), 1),  # bottom of image (not the exact center, where the distortion model is undefined)
+                                                      ])),
+    ])
+
+    run_stage()
+
+    assert redis_publisher_mock.call_count == 1
+
+    # All distortion coefficients are zero, so the result must be the same as without distortion correction
+    msg = SaeMessage()
+    msg.ParseFromString(redis_publisher_mock.call_args_list[0].args[1])
+    assert len(msg.detections) == 1
+    assert msg.detections[0].geo_coordinate.latitude == pytest.approx(9.99996264, abs=1e-7)
+    assert msg.detections[0].geo_coordinate.longitude == pytest.approx(20.00003794, abs=1e-7)
+
+def test_map_mode_multiple_detections(redis_publisher_mock, inject_consumer_messages, set_cameras_config):
+    set_cameras_config([CameraGeomappingConfig(
+        stream_id='stream1',
+        heading_deg=135.0,
+        image_width_px=1920,
+        image_height_px=1080,
+        view_x_deg=60.0,
+        tilt_deg=45.0,
+        elevation_m=10.0,
+    )])
+
+    inject_consumer_messages([
+        ('objecttracker:stream1', _make_sae_msg_bytes(timestamp=1, 
+                                                      source_id='stream1',
+                                                      location=(10.0, 20.0),
+                                                      detections=[
+                                                          _make_detection((0.5, 0.5), 1),  # center of image
+                                                          _make_detection((0.5, 0.9), 2),  # bottom of image (i.e. closer to the camera)
+                                                      ])),
+    ])
+
+    run_stage()
+
+    assert redis_publisher_mock.call_count == 1
+
+    msg = SaeMessage()
+    msg.ParseFromString(redis_publisher_mock.call_args_list[0].args[1])
+    assert len(msg.detections) == 2
+    center_det, bottom_det = msg.detections
+    assert center_det.class_id == 1
+    assert bottom_det.class_id == 2
+
+    # Both detections are mapped to the southeast of the camera, but the bottom one is closer to it
+    assert 0 < (10.0 - bottom_det.geo_coordinate.latitude) < (10.0 - center_det.geo_coordinate.latitude)
+    assert 0 < (bottom_det.geo_coordinate.longitude - 20.0) < (center_det.geo_coordinate.longitude - 20.0)
+
+def test_map_mode_mapping_area(redis_publisher_mock, inject_consumer_messages, set_cameras_config):
+    set_cameras_config([CameraGeomappingConfig(
+        stream_id='stream1',
+        heading_deg=135.0,
+        image_width_px=1920,
+        image_height_px=1080,
+        view_x_deg=60.0,
+        tilt_deg=45.0,
+        elevation_m=10.0,
+        mapping_area={
+            'type': 'Polygon',
+            'coordinates': [[
+                [20.00003, 9.99995],
+                [20.00005, 9.99995],
+                [20.00005, 9.99997],
+                [20.00003, 9.99997],
+                [20.00003, 9.99995],
+            ]],
+        },
+    )])
+
+    inject_consumer_messages([
+        ('objecttracker:stream1', _make_sae_msg_bytes(timestamp=1, 
+                                                      source_id='stream1',
+                                                      location=(10.0, 20.0),
+                                                      detections=[
+                                                          _make_detection((0.5, 0.5), 1),  # center of image, outside of mapping area
+                                                          _make_detection((0.5, 0.9), 2),  # bottom of image, inside of mapping area
+                                                      ])),
+    ])
+
+    run_stage()
+
+    assert redis_publisher_mock.call_count == 1
+
+    msg = SaeMessage()
+    msg.ParseFromString(redis_publisher_mock.call_args_list[0].args[1])
+    assert len(msg.detections) == 2
+    unmapped_det, mapped_det = msg.detections
+    assert not unmapped_det.HasField('geo_coordinate')
+    assert mapped_det.HasField('geo_coordinate')
+    assert 9.99995 < mapped_det.geo_coordinate.latitude < 9.99997
+    assert 20.00003 < mapped_det.geo_coordinate.longitude < 20.00005
+
+def test_map_mode_remove_unmapped_detections(redis_publisher_mock, inject_consumer_messages, set_cameras_config):
+    set_cameras_config([CameraGeomappingConfig(
+        stream_id='stream1',
+        heading_deg=135.0,
+        image_width_px=1920,
+        image_height_px=1080,
+        view_x_deg=60.0,
+        tilt_deg=45.0,
+        elevation_m=10.0,
+        mapping_area={
+            'type': 'Polygon',
+            'coordinates': [[
+                [20.00003, 9.99995],
+                [20.00005, 9.99995],
+                [20.00005, 9.99997],
+                [20.00003, 9.99997],
+                [20.00003, 9.99995],
+            ]],
+        },
+        remove_unmapped_detections=True,
+    )])
+
+    inject_consumer_messages([
+        ('objecttracker:stream1', _make_sae_msg_bytes(timestamp=1, 
+                                                      source_id='stream1',
+                                                      location=(10.0, 20.0),
+                                                      detections=[
+                                                          _make_detection((0.5, 0.5), 1),  # center of image, outside of mapping area
+                                                          _make_detection((0.5, 0.9), 2),  # bottom of image, inside of mapping area
+                                                      ])),
+    ])
+
+    run_stage()
+
+    assert redis_publisher_mock.call_count == 1
+
+    # Assert that only the detection within the mapping area is retained
+    msg = SaeMessage()
+    msg.ParseFromString(redis_publisher_mock.call_args_list[0].args[1])
+    assert len(msg.detections) == 1
+    assert msg.detections[0].class_id == 2
+    assert msg.detections[0].HasField('geo_coordinate')
+
+def test_map_mode_mapping_area_multipolygon(redis_publisher_mock, inject_consumer_messages, set_cameras_config):
+    set_cameras_config([CameraGeomappingConfig(
+        stream_id='stream1',
+        heading_deg=135.0,
+        image_width_px=1920,
+        image_height_px=1080,
+        view_x_deg=60.0,
+        tilt_deg=45.0,
+        elevation_m=10.0,
+        mapping_area={
+            'type': 'MultiPolygon',
+            'coordinates': [
+                [[
+                    [20.00003, 9.99995],
+                    [20.00005, 9.99995],
+                    [20.00005, 9.99997],
+                    [20.00003, 9.99997],
+                    [20.00003, 9.99995],
+                ]],
+                [[
+                    [21.0, 11.0],
+                    [21.1, 11.0],
+                    [21.1, 11.1],
+                    [21.0, 11.1],
+                    [21.0, 11.0],
+                ]],
+            ],
+        },
+        remove_unmapped_detections=True,
+    )])
+
+    inject_consumer_messages([
+        ('objecttracker:stream1', _make_sae_msg_bytes(timestamp=1, 
+                                                      source_id='stream1',
+                                                      location=(10.0, 20.0),
+                                                      detections=[
+                                                          _make_detection((0.5, 0.5), 1),  # center of image, outside of mapping area
+                                                          _make_detection((0.5, 0.9), 2),  # bottom of image, inside of first polygon
+                                                      ])),
+    ])
+
+    run_stage()
+
+    assert redis_publisher_mock.call_count == 1
+
+    # Assert that only the detection within the mapping area is retained
+    msg = SaeMessage()
+    msg.ParseFromString(redis_publisher_mock.call_args_list[0].args[1])
+    assert len(msg.detections) == 1
+    assert msg.detections[0].class_id == 2
+    assert msg.detections[0].HasField('geo_coordinate')
+
+def _unpack_batch(payload: bytes) -> List[bytes]:
+    messages = []
+    offset = 0
+    while offset < len(payload):
+        (length,) = struct.unpack_from('>I', payload, offset)
+        offset += 4
+        messages.append(payload[offset:offset + length])
+        offset += length
+    return messages
+
 def _make_sae_msg_bytes(timestamp: int, source_id: str, location: Tuple[float, float] = None, detections: List[Detection] = None) -> bytes:
     sae_msg = SaeMessage()
     sae_msg.frame.timestamp_utc_ms = timestamp